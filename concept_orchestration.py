@@ -1,8 +1,48 @@
 #!/usr/bin/env python3
-import docker, requests # Docker sdk for python
+import docker # Docker sdk for python
 import numpy as np
 import pandas as pd
 import datetime, time
+import asyncio, atexit, threading
+import concurrent.futures
+import aiohttp
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    ''' returns the event loop serving async predictor requests, started in a daemon thread on first use
+    '''
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    return _loop
+
+_session = None
+
+def _client_session() -> aiohttp.ClientSession:
+    ''' returns the keep-alive http session shared by all predictors, created on first use.
+    The session belongs to the background loop, so predictor coroutines must run there
+    '''
+    global _session
+    if asyncio.get_running_loop() is not _loop:
+        raise RuntimeError('predictor requests must run on the background loop, use get_action() from other code')
+    if _session is None:
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=16, keepalive_timeout=60))
+    return _session
+
+def _close_session():
+    ''' closes the shared http session and stops the background loop at interpreter exit
+    '''
+    if _loop is None:
+        return
+    if _session is not None:
+        asyncio.run_coroutine_threadsafe(_session.close(), _loop).result(timeout=5)
+    _loop.call_soon_threadsafe(_loop.stop)
+
+atexit.register(_close_session)
 
 class ExportedBrainPredictor():
     ''' creates a concept from an exported Brain Docker Container, from which we can get control actions
@@ -25,6 +65,25 @@ class ExportedBrainPredictor():
     def get_action(self, state: dict, iteration: int = 0) -> dict:
         """ Get action from predictor, given a state
         
+        Returns
+        -------
+        action
+        """
+        return self.submit_action(state, iteration).result()
+
+    def submit_action(self, state: dict, iteration: int = 0) -> concurrent.futures.Future:
+        """ Request the action for a state without waiting for it
+        
+        Returns
+        -------
+        future resolving to the action
+        """
+        return asyncio.run_coroutine_threadsafe(self.get_action_async(state, iteration), _background_loop())
+
+    async def get_action_async(self, state: dict, iteration: int = 0) -> dict:
+        """ Get action from predictor, given a state, over the shared keep-alive session.
+        Must run on the background loop, as get_action() and submit_action() do
+        
         Returns
         -------
         action
@@ -32,8 +91,8 @@ class ExportedBrainPredictor():
         exported_brain_url = '{}/v1/prediction'.format(self.predictor_url)
         #print(exported_brain_url)
         if self.is_control_iteration(iteration) == True:
-            response = requests.get(exported_brain_url, json = state)
-            action = response.json()
+            async with _client_session().get(exported_brain_url, json = state) as response:
+                action = await response.json()
         else:
             action = self.last_action
         self.last_action = action
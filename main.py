@@ -15,7 +15,11 @@ Usage:
 """
 
 import json
+import logging
+import math
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, Optional
 from microsoft_bonsai_api.simulator.client import BonsaiClientConfig, BonsaiClient
 from microsoft_bonsai_api.simulator.generated.models import (
@@ -27,73 +31,121 @@ import argparse
 from sim.moab_model import MoabModel
 from jinja2 import Template
 from concept_orchestration import ExportedBrainPredictor, launch_predictor_server
-from pyrr import matrix33, vector
+from policies import random_policy
+
+logger = logging.getLogger(__name__)
+
+C1_URL = 'http://localhost:1111'
+C2_URL = 'http://localhost:2222'
+
+# Episode config keys and the MoabModel attributes they override
+SIM_CONFIG_ATTRS = (
+    # Initial control state which are all unitless in [-1..1]
+    ("initial_roll", "roll"),
+    ("initial_pitch", "pitch"),
+    ("initial_height_z", "height_z"),
+    # Constants, SI units
+    ("time_delta", "time_delta"),
+    ("jitter", "jitter"),
+    ("gravity", "gravity"),
+    ("plate_theta_vel_limit", "plate_theta_vel_limit"),
+    ("plate_theta_acc", "plate_theta_acc"),
+    ("plate_theta_limit", "plate_theta_limit"),
+    ("plate_z_limit", "plate_z_limit"),
+    ("ball_mass", "ball_mass"),
+    ("ball_radius", "ball_radius"),
+    ("ball_shell", "ball_shell"),
+    ("obstacle_radius", "obstacle_radius"),
+    ("obstacle_x", "obstacle_x"),
+    ("obstacle_y", "obstacle_y"),
+    # A target position the AI can try and move the ball to
+    ("target_x", "target_x"),
+    ("target_y", "target_y"),
+    # Observation config
+    ("ball_noise", "ball_noise"),
+    ("plate_noise", "plate_noise"),
+)
+
+# State values are rounded to this many decimals to match cached actions,
+# ignoring the keys that advance on every step
+ACTION_CACHE_DECIMALS = 3
+ACTION_CACHE_IGNORED_KEYS = frozenset(("elapsed_time", "iteration_count"))
 
 class TemplateSimulatorSession():
-    def __init__(self, render):
+    __slots__ = (
+        "simulator", "C1", "C2", "predictors", "_default_predictor",
+        "enable_prefetch", "_pending_action", "_state_cache", "dirty", "sim_config",
+        "enable_action_cache", "_last_predictor", "_last_state_key", "_last_action",
+    )
+
+    def __init__(
+        self,
+        render,
+        C1: Optional[ExportedBrainPredictor] = None,
+        C2: Optional[ExportedBrainPredictor] = None,
+        enable_prefetch: bool = False,
+        enable_action_cache: bool = False,
+    ):
         ## Initialize python api for simulator
         self.simulator = MoabModel()
         
-        C1_url = 'http://localhost:1111'
-        C2_url = 'http://localhost:2222'
-        self.C1 = ExportedBrainPredictor(predictor_url=C1_url, control_period=1)
-        self.C2 = ExportedBrainPredictor(predictor_url=C2_url, control_period=1)
+        # Sessions running in one process can share predictors, and with them
+        # the pooled keep-alive connections
+        self.C1 = C1 or make_predictor_client(C1_URL)
+        self.C2 = C2 or make_predictor_client(C2_URL)
+
+        # Concept selected by the selector's concept_index, C2 when unknown
+        self.predictors = {1: self.C1, 2: self.C2}
+        self._default_predictor = self.C2
+
+        # Request the action for the current state ahead of the next step, as
+        # (predictor, future), so the predictor runs during the platform
+        # round-trip. Off by default: the request is wasted whenever the
+        # selector switches concept.
+        self.enable_prefetch = enable_prefetch
+        self._pending_action = None
+
+        # Snapshot of the simulator state, cleared whenever the simulator changes
+        self._state_cache = None
+
+        # True until the platform has been sent the state after the last change
+        self.dirty = True
+
+        # Reuse the last action while the concept and the quantized state are
+        # unchanged. Off by default as it reduces exploration; meant for
+        # deterministic evaluation.
+        self.enable_action_cache = enable_action_cache
+        self._last_predictor = None
+        self._last_state_key = None
+        self._last_action = None
 
     def get_state(self) -> Dict[str, Any]:
         """Called to retreive the current state of the simulator. """
-        state = self.simulator.state()
-        for key, value in state.items():
-            state[key] = float(value)
+        return dict(self._state())
+
+    def _state(self) -> Dict[str, Any]:
+        """Cached state snapshot, shared with the predictors; must not be mutated."""
+        if self._state_cache is None:
+            self._state_cache = self.simulator.state()
 
-        return state
+        return self._state_cache
 
     def episode_start(self, config: Dict[str, Any]):
         """ Called at the start of each episode """
         
         # Return to pre-determined good state to avoid accidental episode-episode dependencies
         self.simulator.reset()
+        self._pending_action = None
+        self._last_predictor = None
 
         if config is None:
             self.sim_config = {}  
         else:
             self.sim_config = config      
-        # Initial control state which are all unitless in [-1..1] 
-        self.simulator.roll = self.sim_config.get("initial_roll", self.simulator.roll)
-        self.simulator.pitch = self.sim_config.get("initial_pitch", self.simulator.pitch)
-        self.simulator.height_z = self.sim_config.get("initial_height_z", self.simulator.height_z)
-
-        # Constants, SI units
-        self.simulator.time_delta = self.sim_config.get("time_delta", self.simulator.time_delta)
-        self.simulator.jitter = self.sim_config.get("jitter", self.simulator.jitter)
-        self.simulator.gravity = self.sim_config.get("gravity", self.simulator.gravity)
-        self.simulator.plate_theta_vel_limit = self.sim_config.get(
-            "plate_theta_vel_limit", self.simulator.plate_theta_vel_limit
-        )
-        self.simulator.plate_theta_acc = self.sim_config.get(
-            "plate_theta_acc", self.simulator.plate_theta_acc
-        )
-        self.simulator.plate_theta_limit = self.sim_config.get(
-            "plate_theta_limit", self.simulator.plate_theta_limit
-        )
-        self.simulator.plate_z_limit = self.sim_config.get("plate_z_limit", self.simulator.plate_z_limit)
-
-        self.simulator.ball_mass = self.sim_config.get("ball_mass", self.simulator.ball_mass)
-        self.simulator.ball_radius = self.sim_config.get("ball_radius", self.simulator.ball_radius)
-        self.simulator.ball_shell = self.sim_config.get("ball_shell", self.simulator.ball_shell)
-
-        self.simulator.obstacle_radius = self.sim_config.get(
-            "obstacle_radius", self.simulator.obstacle_radius
-        )
-        self.simulator.obstacle_x = self.sim_config.get("obstacle_x", self.simulator.obstacle_x)
-        self.simulator.obstacle_y = self.sim_config.get("obstacle_y", self.simulator.obstacle_y)
-
-        # A target position the AI can try and move the ball to
-        self.simulator.target_x = self.sim_config.get("target_x", self.simulator.target_x)
-        self.simulator.target_y = self.sim_config.get("target_y", self.simulator.target_y)
-
-        # Observation config
-        self.simulator.ball_noise = self.sim_config.get("ball_noise", self.simulator.ball_noise)
-        self.simulator.plate_noise = self.sim_config.get("plate_noise", self.simulator.plate_noise)
+        # Overrides for the initial controls, constants and observation config
+        for key, attr in SIM_CONFIG_ATTRS:
+            if key in self.sim_config:
+                setattr(self.simulator, attr, float(self.sim_config[key]))
 
         # Update the initial plate metrics from the constants and the controls
         self.simulator.update_plate(plate_reset=True)
@@ -106,9 +158,11 @@ class TemplateSimulatorSession():
         )
 
         # Velocity set as a vector
-        self.simulator.ball_vel.x = self.sim_config.get("initial_vel_x", self.simulator.ball_vel.x)
-        self.simulator.ball_vel.y = self.sim_config.get("initial_vel_y", self.simulator.ball_vel.y)
-        self.simulator.ball_vel.z = self.sim_config.get("initial_vel_z", self.simulator.ball_vel.z)
+        self.simulator.ball_vel.xyz = [
+            self.sim_config.get("initial_vel_x", self.simulator.ball_vel.x),
+            self.sim_config.get("initial_vel_y", self.simulator.ball_vel.y),
+            self.sim_config.get("initial_vel_z", self.simulator.ball_vel.z),
+        ]
 
         # Velocity set as a speed/direction towards target
         initial_speed = self.sim_config.get("initial_speed", None)
@@ -116,25 +170,59 @@ class TemplateSimulatorSession():
         if initial_speed is not None and initial_direction is not None:
             self._set_velocity_for_speed_and_direction(initial_speed, initial_direction)
 
+        self._state_cache = None
+        self.dirty = True
+
     def episode_step(self, action: Dict[str, Any]):
         """ Called for each step of the episode """
         ## Add simulator step api here using action from Bonsai platform
         
-        # Use new syntax or fall back to old parameter names
-        if action.get('concept_index') == 1: # selector
-            action = self.C1.get_action(self.get_state())
+        # Get the action from the concept chosen by the selector
+        predictor = self.predictors.get(action.get('concept_index'), self._default_predictor)
+        state_key = self._action_cache_key(self._state())
+        if (
+            state_key is not None
+            and predictor is self._last_predictor
+            and state_key == self._last_state_key
+        ):
+            action = self._last_action
+        elif self._pending_action is not None and self._pending_action[0] is predictor:
+            action = self._pending_action[1].result()
         else:
-            action = self.C2.get_action(self.get_state())
+            action = predictor.get_action(self._state())
+        self._last_predictor, self._last_state_key, self._last_action = (
+            predictor, state_key, action
+        )
         
-        # Clamp inputs to legal ranges
-        self.simulator.roll = self.clamp(
-            action.get("input_roll", self.simulator.roll), -1.0, 1.0)
-        self.simulator.pitch = self.clamp(
-            action.get("input_pitch", self.simulator.pitch), -1.0, 1.0)
-        self.simulator.height_z = self.clamp(
-            action.get("input_height_z", self.simulator.height_z), -1.0, 1.0)
+        # Clamp inputs to legal ranges, inlined as this runs on every step
+        self.simulator.roll, self.simulator.pitch, self.simulator.height_z = (
+            min(1.0, max(-1.0, float(action.get("input_roll", self.simulator.roll)))),
+            min(1.0, max(-1.0, float(action.get("input_pitch", self.simulator.pitch)))),
+            min(1.0, max(-1.0, float(action.get("input_height_z", self.simulator.height_z)))),
+        )
 
         self.simulator.step()
+        self._state_cache = None
+        self.dirty = True
+
+        # Prefetch the next action assuming the selector keeps the same concept,
+        # unless the episode is over or the action cache will answer it
+        if not self.enable_prefetch or self.halted() or (
+            state_key is not None and self._action_cache_key(self._state()) == state_key
+        ):
+            self._pending_action = None
+        else:
+            self._pending_action = (predictor, predictor.submit_action(self._state()))
+
+    def _action_cache_key(self, state: Dict[str, Any]) -> Optional[tuple]:
+        """Quantized state used to match cached actions, None when caching is off."""
+        if not self.enable_action_cache:
+            return None
+        return tuple(
+            round(value, ACTION_CACHE_DECIMALS)
+            for key, value in state.items()
+            if key not in ACTION_CACHE_IGNORED_KEYS
+        )
 
     def halted(self) -> bool:
         """
@@ -142,49 +230,54 @@ class TemplateSimulatorSession():
         """
         return self.simulator.halted() 
 
-    def clamp(self, val: float, min_val: float, max_val: float):
-        """Clamp the values to defined ranges.
-        """
-        return min(max_val, max(min_val, val))
-    
     def _set_velocity_for_speed_and_direction(self, speed: float, direction: float):
         """Set the direction and speed.       
         """
         # Get the heading
         dx = self.simulator.target_x - self.simulator.ball.x
         dy = self.simulator.target_y - self.simulator.ball.y
+        n = math.hypot(dx, dy)
 
         # Direction is meaningless if we're already at the target
-        if (dx != 0) or (dy != 0):
+        if n > 0.0:
 
             # Set the magnitude
-            vel = vector.set_length([dx, dy, 0.0], speed)
+            ux = dx / n * speed
+            uy = dy / n * speed
 
             # Rotate by direction around Z-axis at ball position
-            rot = matrix33.create_from_axis_rotation([0.0, 0.0, 1.0], direction)
-            vel = matrix33.apply_to_vector(rot, vel)
+            s, c = math.sin(direction), math.cos(direction)
 
             # Unpack into ball velocity
-            self.simulator.ball_vel.x = vel[0]
-            self.simulator.ball_vel.y = vel[1]
-            self.simulator.ball_vel.z = vel[2]
+            self.simulator.ball_vel.xyz = [c * ux - s * uy, s * ux + c * uy, 0.0]
+
 
+def make_predictor_client(predictor_url: str) -> ExportedBrainPredictor:
+    """Create the predictor for the exported brain serving at predictor_url."""
+    return ExportedBrainPredictor(predictor_url=predictor_url, control_period=1)
+
+
+def load_interface(interface_path: str, **constants) -> Dict[str, Any]:
+    """Render the interface template with the given constants and parse it."""
+    with open(interface_path, "r") as file:
+        template_str = file.read()
 
-def main(render=False):
+    return json.loads(Template(template_str).render(**constants))
+
+
+def main(render=False, prefetch=False, action_cache=False):
     # Grab standardized way to interact with sim API
-    sim = TemplateSimulatorSession(render= render)
+    sim = TemplateSimulatorSession(
+        render=render, enable_prefetch=prefetch, enable_action_cache=action_cache
+    )
 
     # Configure client to interact with Bonsai service
     config_client = BonsaiClientConfig()
     client = BonsaiClient(config_client)
 
-    # Load json file as simulator integration config type file
-    with open('moab_interface.json', "r") as file:
-        template_str = file.read()
-
-    # render the template with our constants
-    template = Template(template_str)
-    interface_str = template.render(
+    # Load json file as simulator integration config type file, rendered with our constants
+    interface = load_interface(
+        'moab_interface.json',
         initial_pitch=sim.simulator.pitch,
         initial_roll=sim.simulator.roll,
         initial_height_z=sim.simulator.height_z,
@@ -214,7 +307,6 @@ def main(render=False):
         ball_noise=sim.simulator.ball_noise,
         plate_noise=sim.simulator.plate_noise,
     )
-    interface = json.loads(interface_str)
     
     # Create simulator session and init sequence id
     
@@ -229,61 +321,141 @@ def main(render=False):
                             workspace_name=config_client.workspace, 
                             body=registration_info
     )
-    print("Registered simulator.")
+    logger.info("Registered simulator.")
     sequence_id = 1
+    sim_state = None
+
+    def idle(event):
+        time.sleep(event.idle.callback_time)
+        logger.debug('Idling...')
+
+    def unregister(event):
+        client.session.delete(
+            workspace_name=config_client.workspace, 
+            session_id=registered_session.session_id
+        )
+        logger.info("Unregistered simulator.")
+
+    def ignore(event):
+        pass
+
+    # Event handlers by event type, EpisodeStep first as the most frequent
+    handlers = {
+        'EpisodeStep': lambda event: sim.episode_step(event.episode_step.action),
+        'EpisodeStart': lambda event: sim.episode_start(event.episode_start.config),
+        'Idle': idle,
+        'EpisodeFinish': lambda event: logger.debug('Episode Finishing...'),
+        'Unregister': unregister,
+    }
 
     try:
         while True:
-            # Advance by the new state depending on the event type
-            sim_state = SimulatorState(
-                            sequence_id=sequence_id, state=sim.get_state(), 
-                            halted=sim.halted()
-            )
+            # Advance by the new state depending on the event type, reusing
+            # the last one when nothing has happened to the simulator since
+            if sim_state is None or sim.dirty:
+                sim_state = SimulatorState(
+                                sequence_id=sequence_id, state=sim.get_state(), 
+                                halted=sim.halted()
+                )
+                sim.dirty = False
+            else:
+                sim_state.sequence_id = sequence_id
             event = client.session.advance(
                         workspace_name=config_client.workspace, 
                         session_id=registered_session.session_id, 
                         body=sim_state
             )
             sequence_id = event.sequence_id
-            print("[{}] Last Event: {}".format(time.strftime('%H:%M:%S'), 
-                                               event.type))
+            logger.debug("Last Event: %s", event.type)
 
             # Event loop
-            if event.type == 'Idle':
-                time.sleep(event.idle.callback_time)
-                print('Idling...')
-            elif event.type == 'EpisodeStart':
-                sim.episode_start(event.episode_start.config)
-            elif event.type == 'EpisodeStep':
-                sim.episode_step(event.episode_step.action)
-            elif event.type == 'EpisodeFinish':
-                print('Episode Finishing...')
-            elif event.type == 'Unregister':
-                client.session.delete(
-                    workspace_name=config_client.workspace, 
-                    session_id=registered_session.session_id
-                )
-                print("Unregistered simulator.")
-            else:
-                pass
+            handlers.get(event.type, ignore)(event)
     except KeyboardInterrupt:
         # Gracefully unregister with keyboard interrupt
         client.session.delete(
             workspace_name=config_client.workspace, 
             session_id=registered_session.session_id
         )
-        print("Unregistered simulator.")
+        logger.info("Unregistered simulator.")
     except Exception as err:
         # Gracefully unregister for any other exceptions
         client.session.delete(
             workspace_name=config_client.workspace, 
             session_id=registered_session.session_id
         )
-        print("Unregistered simulator because: {}".format(err))
+        logger.error("Unregistered simulator because: %s", err)
+
+def _run_episode(
+    episode: int,
+    num_iterations: int,
+    C1: ExportedBrainPredictor,
+    C2: ExportedBrainPredictor,
+    action_cache: bool = False,
+):
+    """Run one episode on its own session, selecting concepts at random."""
+    sim = TemplateSimulatorSession(
+        render=False, C1=C1, C2=C2, enable_action_cache=action_cache
+    )
+    sim.episode_start({})
+    iteration = 0
+    terminal = False
+    while not terminal:
+        action = random_policy(sim.get_state())
+        sim.episode_step(action)
+        logger.debug("Running iteration #%d for episode #%d", iteration, episode)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Observations: %s", sim.get_state())
+        iteration += 1
+        terminal = iteration >= num_iterations or sim.halted()
+
+
+def test_random_policy(
+    num_episodes: int = 10,
+    num_iterations: int = 250,
+    max_workers: int = 4,
+    action_cache: bool = False,
+):
+    """Test the sim and concept predictors locally, without the Bonsai platform.
+
+    Episodes run in parallel, each on its own session, sharing one predictor
+    per concept so their requests share pooled connections.
+    """
+    C1 = make_predictor_client(C1_URL)
+    C2 = make_predictor_client(C2_URL)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(
+            lambda episode: _run_episode(
+                episode, num_iterations, C1, C2, action_cache
+            ),
+            range(num_episodes)
+        ))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='args for sim integration',
                                      allow_abbrev=False)
     parser.add_argument('--render', action='store_true')
+    parser.add_argument('--test-local', action='store_true',
+                        help='run episodes locally with a random selector policy')
+    parser.add_argument('--num-episodes', type=int, default=10)
+    parser.add_argument('--num-iterations', type=int, default=250)
+    parser.add_argument('--max-workers', type=int, default=4)
+    parser.add_argument('--prefetch', action='store_true',
+                        help='request the next concept action during the platform round-trip')
+    parser.add_argument('--action-cache', action='store_true',
+                        help='reuse the last action while concept and state are unchanged, '
+                             'for deterministic evaluation')
     args, _ = parser.parse_known_args()
-    main(render=args.render)
\ No newline at end of file
+
+    # Per-event messages are logged at DEBUG, set LOG_LEVEL=DEBUG to see them
+    logging.basicConfig(
+        level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+        format='[%(asctime)s] %(message)s',
+        datefmt='%H:%M:%S',
+    )
+    if args.test_local:
+        test_random_policy(
+            args.num_episodes, args.num_iterations, args.max_workers, args.action_cache
+        )
+    else:
+        main(render=args.render, prefetch=args.prefetch, action_cache=args.action_cache)
\ No newline at end of file
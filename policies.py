@@ -10,7 +10,7 @@ def random_policy(state):
     Ignore the state, select randomly.
     """
     action = {
-        'command': random.randint(1, 2)
+        'concept_index': 1 + random.getrandbits(1)
     }
     return action
 
@@ -19,7 +19,7 @@ def coast(state):
     Ignore the state, always select one exported brain.
     """
     action = {
-        'command': 1
+        'concept_index': 1
     }
     return action
 
@@ -8,10 +8,10 @@ __copyright__ = "Copyright 2020, Microsoft Corp."
 
 import math
 import random
-from typing import Dict, Tuple, cast
+from typing import Dict, Tuple
 
 import numpy as np
-from pyrr import Quaternion, Vector3, matrix44, quaternion, ray, vector
+from pyrr import Quaternion, Vector3, matrix44, quaternion, ray
 from pyrr.geometric_tests import ray_intersect_plane
 from pyrr.plane import create_from_position
 
@@ -57,11 +57,6 @@ DEFAULT_PLATE_ANGULAR_ACCEL = (
     100.0 / 1.0
 ) * DEFAULT_PLATE_MAX_ANGULAR_VELOCITY  # rad/s^2
 
-# useful constants
-X_AXIS = np.array([1.0, 0.0, 0.0])
-Y_AXIS = np.array([0.0, 1.0, 0.0])
-Z_AXIS = np.array([0.0, 0.0, 1.0])
-
 # Sensor Actuator Noises
 DEFAULT_PLATE_NOISE = 0.0  # noise added to plate_theta_* (rad)
 DEFAULT_BALL_NOISE = 0.0  # noise added to estimated_* ball location (m)
@@ -73,6 +68,33 @@ def clamp(val: float, min_val: float, max_val: float):
 
 
 class MoabModel:
+    __slots__ = (
+        # general config
+        "time_delta", "jitter", "step_time", "elapsed_time", "gravity",
+        # plate config
+        "plate_noise", "plate_radius", "plate_theta_limit", "plate_theta_vel_limit",
+        "plate_theta_acc", "plate_z_limit",
+        # ball config
+        "ball_noise", "ball_mass", "ball_radius", "ball_shell",
+        # control input
+        "pitch", "roll", "height_z",
+        # plate state
+        "plate_theta_x", "plate_theta_y", "plate",
+        "plate_theta_vel_x", "plate_theta_vel_y", "plate_vel_z",
+        # ball state
+        "ball", "ball_vel", "ball_acc", "ball_qat", "ball_on_plate",
+        # target and obstacle
+        "target_x", "target_y",
+        "obstacle_distance", "obstacle_direction", "obstacle_radius",
+        "obstacle_x", "obstacle_y",
+        # camera observed estimated metrics
+        "estimated_x", "estimated_y", "estimated_vel_x", "estimated_vel_y",
+        "estimated_radius", "estimated_speed", "estimated_direction",
+        "estimated_distance", "prev_estimated_x", "prev_estimated_y",
+        # meta
+        "iteration_count",
+    )
+
     def __init__(self):
         self.reset()
 
@@ -243,7 +265,7 @@ class MoabModel:
         # stop at dest
         else:
             q = dest
-            vel = 0
+            vel = 0.0
 
         return (q, vel)
 
@@ -275,30 +297,17 @@ class MoabModel:
 
         # if the ball is already at the target location or
         # is not moving, return a heading of 0 so we don't
-        # attempt to normalize a zero-length vector
+        # compute a heading from a zero-length vector
         if dx == 0 and dy == 0:
-            return 0
+            return 0.0
         if vel_x == 0 and vel_y == 0:
-            return 0
-
-        # vectors and lengths
-        u = vector.normalize([dx, dy, 0.0])
-        v = vector.normalize([vel_x, vel_y, 0.0])
-        ul = vector.length(u)
-        vl = vector.length(v)
-
-        # no velocity? already on the target?
-        angle = 0.0
-        if (ul != 0.0) and (vl != 0.0):
-            # angle between vectors
-            uv_dot = vector.dot(u, v)
-
-            # signed angle
-            x = u[0]
-            y = u[1]
-            angle = math.atan2(vector.dot([-y, x, 0.0], v), uv_dot)
-            if math.isnan(angle):
-                angle = 0.0
+            return 0.0
+
+        # signed angle between the vectors; atan2 is scale invariant,
+        # so neither vector needs to be normalized first
+        angle = math.atan2(dx * vel_y - dy * vel_x, dx * vel_x + dy * vel_y)
+        if math.isnan(angle):
+            angle = 0.0
         return angle
 
     @staticmethod
@@ -312,20 +321,16 @@ class MoabModel:
 
     # convert X/Y theta components into a Z-Up RH plane normal
     def _plate_nor(self) -> Vector3:
-        x_rot = matrix44.create_from_axis_rotation(
-            axis=X_AXIS, theta=self.plate_theta_x
-        )
-        y_rot = matrix44.create_from_axis_rotation(
-            axis=Y_AXIS, theta=self.plate_theta_y
+        # pitch the Z axis around X, then roll around Y; the result is unit length
+        cos_x = math.cos(self.plate_theta_x)
+        return Vector3(
+            [
+                cos_x * math.sin(self.plate_theta_y),
+                -math.sin(self.plate_theta_x),
+                cos_x * math.cos(self.plate_theta_y),
+            ]
         )
 
-        # pitch then roll
-        nor = matrix44.apply_to_vector(mat=x_rot, vec=Z_AXIS)
-        nor = matrix44.apply_to_vector(mat=y_rot, vec=nor)
-        nor = vector.normalize(nor)
-
-        return Vector3(nor)
-
     def update_plate(self, plate_reset: bool = False):
         # Find the target xth,yth & zpos
         # convert xy[-1..1] to zx[-self.plate_theta_limit .. self.plate_theta_limit]
@@ -455,9 +460,9 @@ class MoabModel:
         )
 
         # update the derived states
-        self.estimated_speed = cast(float, vector.length(
-            [self.ball_vel.x, self.ball_vel.y, self.ball_vel.z]
-        ))
+        self.estimated_speed = math.sqrt(
+            self.ball_vel.x ** 2 + self.ball_vel.y ** 2 + self.ball_vel.z ** 2
+        )
 
         self.estimated_direction = MoabModel.heading_to_point(
             self.estimated_x,
@@ -603,22 +608,18 @@ class MoabModel:
         return Vector3(vec)
 
     def world_to_plate(self, x: float, y: float, z: float) -> Vector3:
-        move = matrix44.create_from_translation(
-            [
-                -self.plate.x,
-                -self.plate.y,
-                -(self.plate.z + PLATE_ORIGIN_TO_SURFACE_OFFSET),
-            ]
-        )
-        vec = matrix44.apply_to_vector(mat=move, vec=[x, y, z])
+        # translate
+        x -= self.plate.x
+        y -= self.plate.y
+        z -= self.plate.z + PLATE_ORIGIN_TO_SURFACE_OFFSET
 
-        # rotate
-        x_rot = matrix44.create_from_axis_rotation([1.0, 0.0, 0.0], -self.plate_theta_x)
-        y_rot = matrix44.create_from_axis_rotation([0.0, 1.0, 0.0], -self.plate_theta_y)
-        vec = matrix44.apply_to_vector(mat=x_rot, vec=vec)
-        vec = matrix44.apply_to_vector(mat=y_rot, vec=vec)
+        # rotate by -plate_theta_x around X, then by -plate_theta_y around Y
+        sin_x, cos_x = math.sin(-self.plate_theta_x), math.cos(-self.plate_theta_x)
+        y, z = y * cos_x - z * sin_x, y * sin_x + z * cos_x
+        sin_y, cos_y = math.sin(-self.plate_theta_y), math.cos(-self.plate_theta_y)
+        x, z = x * cos_y + z * sin_y, z * cos_y - x * sin_y
 
-        return Vector3(vec)
+        return Vector3([x, y, z])
 
     def set_initial_ball(self, x: float, y: float, z: float):
         self.ball.xyz = [x, y, z]
@@ -642,6 +643,8 @@ class MoabModel:
         self._update_estimated_ball(self.ball)
 
     def state(self) -> Dict[str, float]:
+        # numpy scalars from the vector state are cast here so that every
+        # value is a plain float
         # x_theta, y_theta = self._xy_theta_from_nor(self.plate_nor)
         plate_nor = self._plate_nor()
 
@@ -670,38 +673,38 @@ class MoabModel:
             target_x=self.target_x,
             target_y=self.target_y,
             # modelled plate metrics
-            plate_x=self.plate.x,
-            plate_y=self.plate.y,
-            plate_z=self.plate.z,
-            plate_nor_x=plate_nor.x,
-            plate_nor_y=plate_nor.y,
-            plate_nor_z=plate_nor.z,
+            plate_x=float(self.plate.x),
+            plate_y=float(self.plate.y),
+            plate_z=float(self.plate.z),
+            plate_nor_x=float(plate_nor.x),
+            plate_nor_y=float(plate_nor.y),
+            plate_nor_z=float(plate_nor.z),
             plate_theta_x=self.plate_theta_x,
             plate_theta_y=self.plate_theta_y,
             plate_theta_vel_x=self.plate_theta_vel_x,
             plate_theta_vel_y=self.plate_theta_vel_y,
             plate_vel_z=self.plate_vel_z,
             # modelled ball metrics
-            ball_x=self.ball.x,
-            ball_y=self.ball.y,
-            ball_z=self.ball.z,
-            ball_vel_x=self.ball_vel.x,
-            ball_vel_y=self.ball_vel.y,
-            ball_vel_z=self.ball_vel.z,
-            ball_qat_x=self.ball_qat.x,
-            ball_qat_y=self.ball_qat.y,
-            ball_qat_z=self.ball_qat.z,
-            ball_qat_w=self.ball_qat.w,
-            ball_on_plate_x=self.ball_on_plate.x,
-            ball_on_plate_y=self.ball_on_plate.y,
+            ball_x=float(self.ball.x),
+            ball_y=float(self.ball.y),
+            ball_z=float(self.ball.z),
+            ball_vel_x=float(self.ball_vel.x),
+            ball_vel_y=float(self.ball_vel.y),
+            ball_vel_z=float(self.ball_vel.z),
+            ball_qat_x=float(self.ball_qat.x),
+            ball_qat_y=float(self.ball_qat.y),
+            ball_qat_z=float(self.ball_qat.z),
+            ball_qat_w=float(self.ball_qat.w),
+            ball_on_plate_x=float(self.ball_on_plate.x),
+            ball_on_plate_y=float(self.ball_on_plate.y),
             obstacle_distance=self.obstacle_distance,
             obstacle_direction=self.obstacle_direction,
             # modelled camera observations
-            estimated_x=self.estimated_x,
-            estimated_y=self.estimated_y,
-            estimated_radius=self.estimated_radius,
-            estimated_vel_x=self.estimated_vel_x,
-            estimated_vel_y=self.estimated_vel_y,
+            estimated_x=float(self.estimated_x),
+            estimated_y=float(self.estimated_y),
+            estimated_radius=float(self.estimated_radius),
+            estimated_vel_x=float(self.estimated_vel_x),
+            estimated_vel_y=float(self.estimated_vel_y),
             # modelled positions and velocities
             estimated_speed=self.estimated_speed,
             estimated_direction=self.estimated_direction,
@@ -709,6 +712,6 @@ class MoabModel:
             ball_noise=self.ball_noise,
             plate_noise=self.plate_noise,
             # meta vars
-            ball_fell_off=1 if self.halted() else 0,
-            iteration_count=self.iteration_count,
+            ball_fell_off=1.0 if self.halted() else 0.0,
+            iteration_count=float(self.iteration_count),
         )